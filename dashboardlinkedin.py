@@ -1,17 +1,26 @@
 import streamlit as st
-import json
+import io
+import orjson
+import asyncio
 from datetime import datetime
 import pandas as pd
-from collections import Counter
-import matplotlib.pyplot as plt
+import numpy as np
+from collections import Counter, defaultdict
+from itertools import combinations
 from wordcloud import WordCloud
 import plotly.express as px
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import ijson
 from dotenv import load_dotenv
 import os
-from hashlib import md5
+import time
+import threading
+import blake3
 import diskcache
-from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
 import traceback  # Para exibir traceback completo em caso de erro
 
 # Configurações iniciais
@@ -22,59 +31,236 @@ if not API_KEY:
     st.error("A chave API não foi encontrada no arquivo .env.")
     st.stop()
 
+# Sessão HTTP compartilhada pelo processo (st.cache_resource sobrevive aos reruns):
+# reaproveita conexões TCP/TLS e repete falhas transitórias
+@st.cache_resource
+def obter_sessao():
+    sessao = requests.Session()
+    sessao.mount('https://', HTTPAdapter(
+        pool_connections=50,
+        pool_maxsize=50,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    ))
+    return sessao
+
 # Configuração do cache
 cache = diskcache.Cache('./cache_normalizacao')
 
+# Traceback completo apenas no modo debug. Não usar dentro de funções em st.cache_data:
+# o toggle ainda não existe na carga inicial e a saída seria repetida para todas as sessões.
+# Nesses casos o traceback vai para o log do servidor (traceback.print_exc()).
+def exibir_traceback():
+    if st.session_state.get('debug'):
+        st.error(traceback.format_exc())
+
+# Limites da API (gpt-4o-mini) usados no controle proativo de taxa
+MAX_REQUISICOES_POR_MINUTO = 500
+MAX_TOKENS_POR_MINUTO = 200_000
+
+# Acima deste número de perfis a normalizar, a carga vai pela Batch API (assíncrona, 50% mais barata)
+LIMITE_BATCH_API = 200
+
 # Configuração da página
 st.set_page_config(page_title="Dashboard Comunidade", layout="wide")
 
+# Controle de taxa: baldes de requisições e tokens reabastecidos continuamente
+class RateLimiter:
+    def __init__(self, requisicoes_por_minuto, tokens_por_minuto):
+        self.max_request_capacity = requisicoes_por_minuto
+        self.max_token_capacity = tokens_por_minuto
+        self.available_request_capacity = float(requisicoes_por_minuto)
+        self.available_token_capacity = float(tokens_por_minuto)
+        self.ultima_atualizacao = time.monotonic()
+        # Sessões do Streamlit rodam em threads distintas e compartilham o mesmo limitador
+        self._lock = threading.Lock()
+
+    def _reabastecer(self):
+        agora = time.monotonic()
+        decorrido = agora - self.ultima_atualizacao
+        self.ultima_atualizacao = agora
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_request_capacity * decorrido / 60.0,
+            self.max_request_capacity
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_token_capacity * decorrido / 60.0,
+            self.max_token_capacity
+        )
+
+    def try_acquire(self, tokens):
+        with self._lock:
+            self._reabastecer()
+            tokens = min(tokens, self.max_token_capacity)
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= tokens
+                return True
+            return False
+
+# Um único limitador por processo: os limites da API valem para a chave, não para a sessão
+@st.cache_resource
+def obter_rate_limiter():
+    return RateLimiter(MAX_REQUISICOES_POR_MINUTO, MAX_TOKENS_POR_MINUTO)
+
+def corpo_chatgpt(prompt):
+    return {
+        'model': 'gpt-4o-mini',
+        'messages': [{'role': 'user', 'content': prompt}],
+        'temperature': 0.3
+    }
+
 # Função para acessar a API do ChatGPT
-def acessa_chatgpt(prompt):
+async def acessa_chatgpt_async(session, prompt, limiter, max_attempts=3):
     url = 'https://api.openai.com/v1/chat/completions'
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {API_KEY}'
     }
-    data = {
-        'model': 'gpt-4o-mini',
-        'messages': [{'role': 'user', 'content': prompt}],
-        'temperature': 0.3
-    }
+    data = corpo_chatgpt(prompt)
+    est_tokens = len(prompt) // 4 + 2048
     
+    for attempt in range(max_attempts):
+        while not limiter.try_acquire(est_tokens):
+            await asyncio.sleep(0.01)
+        try:
+            async with session.post(url, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=60)) as response:
+                if response.status != 429:
+                    response.raise_for_status()
+                    resposta = await response.json()
+                    return resposta['choices'][0]['message']['content']
+                retry_after = response.headers.get('Retry-After')
+        except Exception as e:
+            st.error(f"Erro na API do ChatGPT: {str(e)}")
+            traceback.print_exc()
+            return None
+        # 429: aguarda o Retry-After (ou backoff exponencial) antes de tentar novamente
+        if attempt < max_attempts - 1:
+            try:
+                espera = float(retry_after)
+            except (TypeError, ValueError):
+                espera = 2 ** attempt
+            await asyncio.sleep(espera)
+    
+    st.error(f"Erro na API do ChatGPT: limite de requisições excedido após {max_attempts} tentativas.")
+    return None
+
+async def _limitado(sem, coro):
+    async with sem:
+        return await coro
+
+async def despachar_prompts(prompts, max_simultaneas=20):
+    # Dispara todos os prompts em paralelo, limitando as requisições simultâneas.
+    # gather preserva a ordem, então respostas[i] corresponde a prompts[i].
+    sem = asyncio.Semaphore(max_simultaneas)
+    limiter = obter_rate_limiter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100)) as session:
+        return await tqdm_asyncio.gather(
+            *[_limitado(sem, acessa_chatgpt_async(session, prompt, limiter)) for prompt in prompts],
+            desc="Processando perfis"
+        )
+
+# Carga em massa pela Batch API: um único .jsonl enviado e processado pela OpenAI.
+# O id do lote fica no cache até a saída ser baixada: se o lote não terminar dentro de
+# tempo_maximo (ou o download falhar), retorna respostas vazias e a próxima carga retoma
+# o mesmo lote em vez de enviar (e pagar) outro. Retorna None apenas quando não há lote
+# aproveitável (falha no envio ou lote failed/expired/cancelled), para usar a API em tempo real.
+def acessa_chatgpt_batch(prompts, intervalo=10, tempo_maximo=180):
+    url = 'https://api.openai.com/v1'
+    headers = {'Authorization': f'Bearer {API_KEY}'}
+    sessao = obter_sessao()
+    chave_lote = f"batch_api:{stable_hash(prompts).hexdigest()}"
+    
+    lote_id = None
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=60)
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
+        lote_id = cache.get(chave_lote, default=None)
+        if lote_id is None:
+            linhas = [
+                orjson.dumps({
+                    'custom_id': str(i),
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': corpo_chatgpt(prompt)
+                })
+                for i, prompt in enumerate(prompts)
+            ]
+            arquivo = sessao.post(f'{url}/files', headers=headers, data={'purpose': 'batch'},
+                                  files={'file': ('requests.jsonl', b'\n'.join(linhas))}, timeout=120)
+            arquivo.raise_for_status()
+            response = sessao.post(f'{url}/batches', headers=headers, json={
+                'input_file_id': arquivo.json()['id'],
+                'endpoint': '/v1/chat/completions',
+                'completion_window': '24h'
+            }, timeout=60)
+            response.raise_for_status()
+            lote_id = response.json()['id']
+            cache.set(chave_lote, lote_id, expire=24 * 3600)
+        
+        prazo = time.monotonic() + tempo_maximo
+        while True:
+            response = sessao.get(f"{url}/batches/{lote_id}", headers=headers, timeout=60)
+            response.raise_for_status()
+            lote = response.json()
+            if lote['status'] in ('completed', 'failed', 'expired', 'cancelled'):
+                break
+            if time.monotonic() >= prazo:
+                st.warning("O lote da Batch API ainda está em processamento; os perfis serão normalizados em uma próxima carga.")
+                return [None] * len(prompts)
+            time.sleep(intervalo)
+        
+        if lote['status'] != 'completed' or not lote.get('output_file_id'):
+            cache.delete(chave_lote)
+            raise RuntimeError(f"Lote {lote_id} terminou com status '{lote['status']}'")
+        
+        saida = sessao.get(f"{url}/files/{lote['output_file_id']}/content", headers=headers, timeout=120)
+        saida.raise_for_status()
+        cache.delete(chave_lote)
     except Exception as e:
-        st.error(f"Erro na API do ChatGPT: {str(e)}")
-        st.error(traceback.format_exc())
+        st.error(f"Erro na Batch API do ChatGPT: {str(e)}")
+        traceback.print_exc()
+        # Lote ainda registrado (em andamento ou concluído sem download): retomar na próxima carga
+        if lote_id is not None and chave_lote in cache:
+            return [None] * len(prompts)
         return None
+    
+    # A saída não segue a ordem de envio: custom_id devolve cada resposta ao seu prompt.
+    # Linhas malformadas deixam a entrada correspondente como None.
+    respostas = [None] * len(prompts)
+    for linha in saida.content.splitlines():
+        if not linha.strip():
+            continue
+        try:
+            item = orjson.loads(linha)
+            resposta = item.get('response') or {}
+            if resposta.get('status_code') == 200:
+                indice = int(item['custom_id'])
+                if 0 <= indice < len(respostas):
+                    respostas[indice] = resposta['body']['choices'][0]['message']['content']
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+            traceback.print_exc()
+    return respostas
 
 # Funções auxiliares para processar dados
-def extrair_mes(aniversario):
-    try:
-        aniversario_normalizado = aniversario.lower().replace('ã', 'a').replace('õ', 'o')
-        if 'informado' in aniversario_normalizado:
-            return None
-        partes = aniversario.split("/")
-        if len(partes) >= 2:
-            mes = int(partes[1])
-            if 1 <= mes <= 12:
-                return mes
-    except Exception:
-        pass
-    return None
-
-def extrair_estado(local):
-    if pd.isna(local) or local.lower() in ["não informado", "nao informado"]:
-        return "Não informado"
-    if '/' in local:
-        return local.split('/')[-1].strip()
-    if ',' in local:
-        return local.split(',')[-1].strip()
-    return local
+def extrair_dia_mes(aniversarios):
+    # Dia (1-31) e mês (1-12) de cada data "dia/mês"; <NA> para datas ausentes ou inválidas
+    partes = aniversarios.astype('string').str.split('/')
+    dia = pd.to_numeric(partes.str[0].str.strip(), errors='coerce')
+    mes = pd.to_numeric(partes.str[1].str.strip(), errors='coerce')
+    dia = dia.where(dia.between(1, 31) & (dia % 1 == 0)).astype('Int8')
+    mes = mes.where(mes.between(1, 12) & (mes % 1 == 0)).astype('Int8')
+    return dia, mes
+
+def extrair_estados(locais):
+    s = locais.astype('string')
+    mask_na = s.isna() | s.str.lower().isin(["não informado", "nao informado"])
+    tem_barra = s.str.contains('/', regex=False).fillna(False)
+    tem_virgula = s.str.contains(',', regex=False).fillna(False)
+    estado = s.mask(tem_barra, s.str.rsplit('/', n=1).str[-1].str.strip())
+    estado = estado.mask(~tem_barra & tem_virgula, s.str.rsplit(',', n=1).str[-1].str.strip())
+    return estado.mask(mask_na, "Não informado")
 
 def obter_interesses(perfil):
+    if '_interesses' in perfil:
+        return perfil['_interesses']
     interesses = perfil.get('interesses', [])
     if isinstance(interesses, list):
         return [tag.lower().strip() for tag in interesses if isinstance(tag, str) and tag.strip()]
@@ -85,6 +271,8 @@ def obter_interesses(perfil):
         return []
 
 def obter_areas(perfil):
+    if '_areas' in perfil:
+        return perfil['_areas']
     area = perfil.get('área', "")
     if isinstance(area, list):
         return [tag.lower().strip() for tag in area if isinstance(tag, str) and tag.strip()]
@@ -94,20 +282,38 @@ def obter_areas(perfil):
         st.warning(f"Formato inesperado para 'área' no perfil: {perfil.get('nome', 'Sem Nome')}")
         return []
 
+# Hash estável de estruturas JSON (chaves ordenadas, serializadas pelo orjson)
+def stable_hash(obj):
+    return blake3.blake3(orjson.dumps(obj, option=orjson.OPT_SORT_KEYS))
+
+# Empacotamento JSONH: coleção homogênea sem repetir os nomes dos campos.
+# Só os campos que a IA normaliza são enviados; os demais são reanexados localmente.
+CAMPOS_NORMALIZACAO = ["id", "local", "área", "interesses"]
+
+def jsonh_pack(rows, keys):
+    return [len(keys)] + keys + [v for r in rows for v in (r.get(k, "") for k in keys)]
+
+def jsonh_unpack(packed):
+    if not isinstance(packed, list) or not packed or not isinstance(packed[0], int):
+        raise ValueError("Resposta não está no formato JSONH")
+    n = packed[0]
+    keys = packed[1:1 + n]
+    values = packed[1 + n:]
+    if n <= 0 or len(keys) != n or len(values) % n:
+        raise ValueError("Resposta JSONH com número de valores inconsistente")
+    return [dict(zip(keys, values[i:i + n])) for i in range(0, len(values), n)]
+
+@st.cache_data(ttl=3600, show_spinner=False)
 def normalizar_dados(perfis):
     template = """Analise e padronize os seguintes campos para cada perfil:
 - Local (formato: "Cidade/UF" ou "Cidade, País")
 - Área (tags em lowercase sem caracteres especiais, separadas por #)
 - Interesses (mesmo critério das áreas)
 
-Retorne APENAS um JSON com os perfis normalizados, com os campos:
-- nome
-- local
-- área
-- interesses
-- url linkedin
-- newsletter
-- aniversario
+Os perfis originais estão em formato JSONH (um único array plano, sem repetir os nomes dos campos).
+
+Retorne APENAS um array JSONH no mesmo formato: primeiro inteiro = número de chaves, depois as chaves, depois os valores linha a linha.
+Use as chaves: id, local, área, interesses (mantenha o id original de cada perfil)
 
 Perfis originais:
 {perfis_json}
@@ -116,97 +322,279 @@ Perfis originais:
     perfis_normalizados = []
     perfis_para_normalizar = []
     perfis_hashes = []
-
-    for perfil in perfis:
-        try:
-            perfil_hash = md5(json.dumps(perfil, sort_keys=True).encode()).hexdigest()
-            if perfil_hash in cache:
-                perfis_normalizados.append(cache[perfil_hash])
-            else:
-                perfis_para_normalizar.append(perfil)
-                perfis_hashes.append(perfil_hash)
-        except Exception as e:
-            st.error(f"Erro ao processar hash para perfil {perfil.get('nome', '')}: {str(e)}")
-            st.error(traceback.format_exc())
-            perfis_normalizados.append(perfil)
+    # Perfis mantidos no formato original por falha (API, JSON ou campos ausentes)
+    perfis_sem_normalizacao = 0
+
+    # Uma única transação SQLite para todas as leituras do cache
+    with cache.transact():
+        for perfil in perfis:
+            try:
+                perfil_hash = stable_hash(perfil).hexdigest()
+                perfil_cache = cache.get(perfil_hash, default=None)
+                if perfil_cache is not None:
+                    perfis_normalizados.append(perfil_cache)
+                else:
+                    perfis_para_normalizar.append(perfil)
+                    perfis_hashes.append(perfil_hash)
+            except Exception as e:
+                st.error(f"Erro ao processar hash para perfil {perfil.get('nome', '')}: {str(e)}")
+                traceback.print_exc()
+                perfis_normalizados.append(perfil)
+                perfis_sem_normalizacao += 1
 
     if perfis_para_normalizar:
         batch_size = 20
         batches = [perfis_para_normalizar[i:i + batch_size] for i in range(0, len(perfis_para_normalizar), batch_size)]
         batch_hashes = [perfis_hashes[i:i + batch_size] for i in range(0, len(perfis_hashes), batch_size)]
         
+        prompts = []
+        for batch in batches:
+            minimal = [{"id": i, "local": p.get("local"), "área": p.get("área"), "interesses": p.get("interesses")} for i, p in enumerate(batch)]
+            prompts.append(template.format(perfis_json=orjson.dumps(jsonh_pack(minimal, CAMPOS_NORMALIZACAO)).decode()))
+        
         with st.spinner('Normalizando dados com IA...'):
-            for batch, hashes in tqdm(zip(batches, batch_hashes), total=len(batches), desc="Processando perfis"):
-                prompt = template.format(perfis_json=json.dumps(batch, ensure_ascii=False))
-                resposta = acessa_chatgpt(prompt)
-                if resposta:
-                    try:
-                        resposta_limpa = resposta.replace('```json', '').replace('```', '').strip()
-                        perfis_batch_normalizados = json.loads(resposta_limpa)
+            respostas = None
+            if len(perfis_para_normalizar) > LIMITE_BATCH_API:
+                respostas = acessa_chatgpt_batch(prompts)
+            if respostas is None:
+                respostas = asyncio.run(despachar_prompts(prompts))
+            with cache.transact():
+                for batch, hashes, resposta in zip(batches, batch_hashes, respostas):
+                    if resposta:
+                        try:
+                            resposta_limpa = resposta.replace('```json', '').replace('```', '').strip()
+                            # O modelo pode devolver o id como texto ("0"); linhas sem id válido são ignoradas
+                            linhas_modelo = {}
+                            for linha in jsonh_unpack(orjson.loads(resposta_limpa)):
+                                try:
+                                    linhas_modelo[int(linha['id'])] = linha
+                                except (KeyError, ValueError, TypeError):
+                                    continue
                         
-                        for perfil_normalizado, perfil_hash in zip(perfis_batch_normalizados, hashes):
-                            if all(key in perfil_normalizado for key in ['nome', 'local', 'área', 'interesses']):
-                                cache[perfil_hash] = perfil_normalizado
-                                perfis_normalizados.append(perfil_normalizado)
-                            else:
-                                st.warning(f"Perfil {perfil_normalizado.get('nome', 'Sem Nome')} não possui todos os campos necessários. Mantendo o original.")
-                                perfis_normalizados.append(perfil)
-                    except json.JSONDecodeError as e:
-                        st.error(f"Erro ao decodificar JSON: {str(e)}")
-                        st.error(traceback.format_exc())
+                            for i, (perfil, perfil_hash) in enumerate(zip(batch, hashes)):
+                                linha = linhas_modelo.get(i)
+                                if linha and all(key in linha for key in ['local', 'área', 'interesses']):
+                                    # Reanexa os campos não enviados (nome, url linkedin, newsletter, aniversario)
+                                    perfil_normalizado = {**perfil, **{k: v for k, v in linha.items() if k != 'id'}}
+                                    cache[perfil_hash] = perfil_normalizado
+                                    perfis_normalizados.append(perfil_normalizado)
+                                else:
+                                    st.warning(f"Perfil {perfil.get('nome', 'Sem Nome')} não possui todos os campos necessários. Mantendo o original.")
+                                    perfis_normalizados.append(perfil)
+                                    perfis_sem_normalizacao += 1
+                        except (ValueError, TypeError) as e:
+                            st.error(f"Erro ao decodificar JSON: {str(e)}")
+                            traceback.print_exc()
+                            perfis_normalizados.extend(batch)
+                            perfis_sem_normalizacao += len(batch)
+                    else:
                         perfis_normalizados.extend(batch)
-                else:
-                    perfis_normalizados.extend(batch)
+                        perfis_sem_normalizacao += len(batch)
 
-    return perfis_normalizados
+    return perfis_normalizados, perfis_sem_normalizacao
 
+@st.cache_data(ttl=3600, show_spinner=False)
 def carregar_dados():
     url = "https://drive.google.com/file/d/1Rx5BRqQYIpvXfzX7wAAxPM7w1vF7F927/view?usp=drive_link"
     
     try:
         file_id = url.split('/d/')[1].split('/')[0]
         download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
-        response = requests.get(download_url)
-        response.raise_for_status()
-        return response.json()
+        # Download em streaming: os perfis são decodificados à medida que os bytes chegam
+        with obter_sessao().get(download_url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            return list(ijson.items(response.raw, 'item', use_float=True))
     except Exception as e:
         st.error(f"Erro ao carregar arquivo: {str(e)}")
-        st.error(traceback.format_exc())
+        traceback.print_exc()
         return None
 
-def processar_tags(perfis, campo):
-    tags = []
-    for p in perfis:
-        if campo == "interesses":
-            tags.extend(obter_interesses(p))
-        elif campo == "área":
-            tags.extend(obter_areas(p))
-    return Counter(tags)
+# Visões derivadas, memoizadas por conjunto de perfis e localização selecionada.
+# TTL igual ao do carregamento: cada recarga gera um novo perfis_id e as entradas antigas expiram.
+MAX_VISOES_EM_CACHE = 64
+# Argumentos iniciados com "_" ficam fora da chave do cache: perfis_id e local a definem.
+@st.cache_data(ttl=3600, max_entries=MAX_VISOES_EM_CACHE, show_spinner=False)
+def filtrar_perfis(_perfis, perfis_id, local):
+    dados = [
+        p for p in _perfis 
+        if local == "Todos" or p["local"] == local
+    ]
+    df = pd.DataFrame(dados)
+    aniversarios = df.get("aniversario", pd.Series("não informado", index=df.index)).fillna("não informado").astype('string')
+    df['dia'], df['mes'] = extrair_dia_mes(aniversarios)
+    return dados, df, aniversarios
+
+@st.cache_data(ttl=3600, max_entries=MAX_VISOES_EM_CACHE, show_spinner=False)
+def contar_tags(_perfis, perfis_id, local):
+    # Contagem de áreas e interesses em uma única passada
+    contagem_areas = Counter()
+    contagem_interesses = Counter()
+    for p in _perfis:
+        contagem_areas.update(p['_areas'])
+        contagem_interesses.update(p['_interesses'])
+    return contagem_areas, contagem_interesses
+
+@st.cache_data(ttl=3600, max_entries=MAX_VISOES_EM_CACHE, show_spinner=False)
+def gerar_wordcloud_png(frequencias):
+    # Renderiza direto para PNG, sem passar por figuras do matplotlib
+    wordcloud = WordCloud(width=800, height=400, background_color='white').generate_from_frequencies(dict(frequencias))
+    buf = io.BytesIO()
+    wordcloud.to_image().save(buf, 'PNG')
+    return buf.getvalue()
+
+@st.cache_data(ttl=3600, max_entries=MAX_VISOES_EM_CACHE, show_spinner=False)
+def calcular_estados(_df, perfis_id, local):
+    return (
+        extrair_estados(_df["local"])
+        .rename("estado")
+        .value_counts()
+        .reset_index()
+        .rename(columns={"index": "Estado", "estado": "Contagem"})
+    )
+
+@st.cache_data(ttl=3600, max_entries=MAX_VISOES_EM_CACHE, show_spinner=False)
+def calcular_hierarquia(_perfis, perfis_id, local):
+    data = []
+    for p in _perfis:
+        areas = p['_areas']
+        if len(areas) >= 2:
+            data.append({"Categoria": areas[0].capitalize(), "Subcategoria": areas[1].capitalize()})
+        elif len(areas) == 1:
+            data.append({"Categoria": areas[0].capitalize(), "Subcategoria": "Geral"})
+    return pd.DataFrame(data)
+
+@st.cache_data(ttl=3600, max_entries=MAX_VISOES_EM_CACHE, show_spinner=False)
+def calcular_relacoes(_perfis, _contagem_areas, _contagem_interesses, perfis_id, local):
+    # Selecionar as top 15 áreas e interesses para evitar matrizes muito grandes;
+    # eixos em ordem alfabética, como no pivot_table original
+    areas = sorted((area for area, _ in _contagem_areas.most_common(15)), key=str.capitalize)
+    interesses = sorted((interesse for interesse, _ in _contagem_interesses.most_common(15)), key=str.capitalize)
+    area_to_i = {area: i for i, area in enumerate(areas)}
+    interesse_to_i = {interesse: i for i, interesse in enumerate(interesses)}
+    
+    # Pares (perfil, tag) crescem com o número de tags, não de combinações área x interesse
+    perfis_a, areas_idx = [], []
+    perfis_i, interesses_idx = [], []
+    for n, p in enumerate(_perfis):
+        for tag in p['_areas']:
+            if tag in area_to_i:
+                perfis_a.append(n)
+                areas_idx.append(area_to_i[tag])
+        for tag in p['_interesses']:
+            if tag in interesse_to_i:
+                perfis_i.append(n)
+                interesses_idx.append(interesse_to_i[tag])
+    
+    # Matrizes perfil x área e perfil x interesse; a coocorrência é o produto A^T I
+    A = np.zeros((len(_perfis), len(areas)), dtype=np.int32)
+    I = np.zeros((len(_perfis), len(interesses)), dtype=np.int32)
+    np.add.at(A, (np.array(perfis_a, dtype=np.intp), np.array(areas_idx, dtype=np.intp)), 1)
+    np.add.at(I, (np.array(perfis_i, dtype=np.intp), np.array(interesses_idx, dtype=np.intp)), 1)
+    M = A.T @ I
+    
+    # Descartar linhas/colunas sem nenhuma relação, como no pivot original
+    linhas = M.any(axis=1)
+    colunas = M.any(axis=0)
+    return pd.DataFrame(
+        M[linhas][:, colunas],
+        index=[area.capitalize() for area, manter in zip(areas, linhas) if manter],
+        columns=[interesse.capitalize() for interesse, manter in zip(interesses, colunas) if manter]
+    )
+
+@st.cache_data(ttl=3600, max_entries=MAX_VISOES_EM_CACHE, show_spinner=False)
+def calcular_atividades(_df, perfis_id, local):
+    # Contagens por perfil a partir das tags já normalizadas
+    df_tags = _df[['local', '_areas', '_interesses']].assign(
+        n_areas=_df['_areas'].str.len(),
+        n_interesses=_df['_interesses'].str.len()
+    )
+    
+    # Agrupar dados por Localização com nomes de colunas únicos
+    agrupado = df_tags.groupby('local').agg(
+        Numero_Areas=('n_areas', 'sum'),
+        Numero_Interesses=('n_interesses', 'sum')
+    ).reset_index()
+    
+    # Obter top 3 interesses por localização
+    contagens = (
+        df_tags[['local', '_interesses']]
+        .explode('_interesses')
+        .dropna()
+        .groupby(['local', '_interesses'])
+        .size()
+        .sort_values(ascending=False, kind='stable')
+    )
+    top_interesses_local = (
+        contagens.groupby(level=0).head(3)
+        .index.to_frame(index=False)
+        .groupby('local')['_interesses']
+        .agg(', '.join)
+    )
+    agrupado['Top_Interesses'] = agrupado['local'].map(top_interesses_local).fillna('')
+    
+    # Renomear colunas para nomes únicos
+    return agrupado.rename(columns={
+        'local': 'Local',
+        'Numero_Areas': 'Áreas',
+        'Numero_Interesses': 'Total_Interesses'  # Renomear para evitar duplicação
+    })
+
+@st.cache_data(ttl=3600, max_entries=MAX_VISOES_EM_CACHE, show_spinner=False)
+def calcular_pares(_perfis, perfis_id, local, limite=3):
+    # Índice invertido interesse -> perfis: só compara perfis que compartilham alguma tag
+    inv = defaultdict(list)
+    for idx, p in enumerate(_perfis):
+        for tag in dict.fromkeys(p['_interesses']):  # dedup preservando a ordem
+            inv[tag].append(idx)
+    
+    pares = []
+    seen = set()
+    for bucket in inv.values():
+        for i, j in combinations(bucket, 2):
+            if (i, j) not in seen:
+                seen.add((i, j))
+                pares.append((_perfis[i].get('nome', 'Sem Nome'), _perfis[j].get('nome', 'Sem Nome')))
+                if len(pares) >= limite:
+                    return pares
+    return pares
 
 # Carregar e processar dados
 if 'perfis' not in st.session_state:
     dados_brutos = carregar_dados()
     if dados_brutos:
-        st.session_state.perfis = normalizar_dados(dados_brutos)
+        st.session_state.perfis, perfis_sem_normalizacao = normalizar_dados(dados_brutos)
+        if perfis_sem_normalizacao:
+            # Não manter resultados degradados em cache: a próxima carga tenta normalizá-los de novo
+            normalizar_dados.clear()
+        # Tags normalizadas calculadas uma única vez por perfil
+        for p in st.session_state.perfis:
+            p['_areas'] = obter_areas(p)
+            p['_interesses'] = obter_interesses(p)
+            p['_search_blob'] = ((p.get('nome') or '') + ' ' + ' '.join(p['_areas']) + ' ' + ' '.join(p['_interesses'])).lower()
     else:
+        # Não manter uma falha de download em cache
+        carregar_dados.clear()
         st.stop()
 
+# Identificador dos perfis carregados, chave das visões em cache (também para sessões antigas)
+if 'perfis_id' not in st.session_state:
+    st.session_state.perfis_id = stable_hash(st.session_state.perfis).hexdigest()
+
 # Sidebar - Filtros
 st.sidebar.title("🔍 Filtros")
 local_options = ["Todos"] + sorted({p["local"] for p in st.session_state.perfis if p["local"] != "Não informado"})
 local_selecionado = st.sidebar.selectbox("Localização", local_options)
+st.sidebar.checkbox("Debug", key='debug')
 
-# Processamento de dados filtrados
-dados_filtrados = [
-    p for p in st.session_state.perfis 
-    if local_selecionado == "Todos" or p["local"] == local_selecionado
-]
-
-# Converter dados_filtrados para DataFrame
-df_dados_filtrados = pd.DataFrame(dados_filtrados)
+# Processamento de dados filtrados (em cache por localização)
+perfis_id = st.session_state.perfis_id
+dados_filtrados, df_dados_filtrados, aniversarios = filtrar_perfis(st.session_state.perfis, perfis_id, local_selecionado)
+contagem_areas, contagem_interesses = contar_tags(dados_filtrados, perfis_id, local_selecionado)
 
 # Opcional: Exibir os primeiros registros para verificação
-# st.write("### Exemplos de Dados Normalizados", df_dados_filtrados.head())
+if st.session_state.get('debug'):
+    st.write("### Exemplos de Dados Normalizados", df_dados_filtrados.head())
 
 # 1. Visão Geral
 st.title("📊 Dashboard (insights) - Imflue Circle")
@@ -221,29 +609,16 @@ with col3:
     st.metric("Newsletters Ativas", f"{newsletters_ativas} ({percentage})")
 with col4:
     mes_atual = datetime.now().month
-    aniversariantes = []
-    for p in dados_filtrados:
-        aniversario = p.get("aniversario", "não informado")
-        if aniversario.lower() not in ["não informado", "nao informado"]:
-            mes = extrair_mes(aniversario)
-            if mes == mes_atual:
-                aniversariantes.append(p)
-            elif mes is None:
-                st.warning(f"Formato de aniversário inválido para o perfil: {p.get('nome', 'Sem Nome')}, aniversário: '{aniversario}'")
+    invalidos = ~aniversarios.str.lower().isin(["não informado", "nao informado"]) & df_dados_filtrados['mes'].isna()
+    for i in invalidos[invalidos].index:
+        st.warning(f"Formato de aniversário inválido para o perfil: {dados_filtrados[i].get('nome', 'Sem Nome')}, aniversário: '{aniversarios[i]}'")
+    aniversariantes = [dados_filtrados[i] for i in df_dados_filtrados.index[(df_dados_filtrados['mes'] == mes_atual).fillna(False)]]
     st.metric("Aniversariantes do Mês", len(aniversariantes))
 
 # 2. Distribuição Geográfica
 st.subheader("🌍 Distribuição Geográfica")
 
-df_localizacao = pd.DataFrame([p["local"] for p in dados_filtrados], columns=["local"])
-df_localizacao["estado"] = df_localizacao["local"].apply(extrair_estado)
-
-estado_counts = (
-    df_localizacao["estado"]
-    .value_counts()
-    .reset_index()
-    .rename(columns={"index": "Estado", "estado": "Contagem"})
-)
+estado_counts = calcular_estados(df_dados_filtrados, perfis_id, local_selecionado)
 
 if not estado_counts.empty and {"Estado", "Contagem"}.issubset(estado_counts.columns):
     fig = px.bar(
@@ -263,19 +638,15 @@ col1, col2 = st.columns(2)
 
 with col1:
     st.write("**Nuvem de Palavras**")
-    todas_tags = processar_tags(dados_filtrados, "área") + processar_tags(dados_filtrados, "interesses")
+    todas_tags = contagem_areas + contagem_interesses
     if todas_tags:
-        wordcloud = WordCloud(width=800, height=400, background_color='white').generate_from_frequencies(todas_tags)
-        plt.figure(figsize=(10,5))
-        plt.imshow(wordcloud, interpolation='bilinear')
-        plt.axis("off")
-        st.pyplot(plt)
+        st.image(gerar_wordcloud_png(tuple(todas_tags.most_common())), use_container_width=True)
     else:
         st.write("Nenhuma tag disponível para gerar a nuvem de palavras.")
 
 with col2:
     st.write("**Top 10 Áreas de Atuação**")
-    areas_top = processar_tags(dados_filtrados, "área").most_common(10)
+    areas_top = contagem_areas.most_common(10)
     if areas_top:
         df_areas_top = pd.DataFrame(areas_top, columns=["Área", "Contagem"])
         fig = px.bar(df_areas_top, x="Área", y="Contagem", labels={"Área": "Área", "Contagem": "Número de Membros"}, color="Área")
@@ -286,15 +657,7 @@ with col2:
 # 3.2 Treemap Hierárquico
 st.write("**Distribuição Hierárquica de Áreas**")
 try:
-    data = []
-    for p in dados_filtrados:
-        areas = obter_areas(p)
-        if len(areas) >= 2:
-            data.append({"Categoria": areas[0].capitalize(), "Subcategoria": areas[1].capitalize()})
-        elif len(areas) == 1:
-            data.append({"Categoria": areas[0].capitalize(), "Subcategoria": "Geral"})
-    
-    df_hierarquia = pd.DataFrame(data)
+    df_hierarquia = calcular_hierarquia(dados_filtrados, perfis_id, local_selecionado)
     
     if not df_hierarquia.empty:
         fig = px.treemap(
@@ -308,32 +671,15 @@ try:
         st.write("Dados insuficientes para gerar o treemap.")
 except Exception as e:
     st.error(f"Erro ao gerar treemap: {str(e)}")
-    st.error(traceback.format_exc())
+    exibir_traceback()
 
 # 3.3 Mapa de Calor de Relações
 st.subheader("🔥 Relação entre Áreas e Interesses")
 try:
-    # Selecionar as top 15 áreas e interesses para evitar matrizes muito grandes
-    top_areas = processar_tags(dados_filtrados, "área").most_common(15)
-    top_interesses = processar_tags(dados_filtrados, "interesses").most_common(15)
-    areas = [area for area, _ in top_areas]
-    interesses = [interesse for interesse, _ in top_interesses]
-    
-    # Criar DataFrame de relações
-    data = []
-    for p in dados_filtrados:
-        p_areas = [tag.lower() for tag in obter_areas(p) if tag.lower() in areas]
-        p_interesses = [tag.lower() for tag in obter_interesses(p) if tag.lower() in interesses]
-        for area in p_areas:
-            for interesse in p_interesses:
-                data.append({"Área": area.capitalize(), "Interesse": interesse.capitalize()})
-    
-    df_relacoes = pd.DataFrame(data)
+    df_relacoes = calcular_relacoes(dados_filtrados, contagem_areas, contagem_interesses, perfis_id, local_selecionado)
     if not df_relacoes.empty:
-        pivot_table = df_relacoes.pivot_table(index='Área', columns='Interesse', aggfunc='size', fill_value=0)
-        
         fig = px.imshow(
-            pivot_table,
+            df_relacoes,
             labels=dict(x="Interesse", y="Área", color="Frequência"),
             color_continuous_scale="YlOrRd",
             aspect="auto"
@@ -343,7 +689,7 @@ try:
         st.write("Dados insuficientes para gerar o mapa de calor.")
 except Exception as e:
     st.error(f"Erro ao gerar mapa de calor: {str(e)}")
-    st.error(traceback.format_exc())
+    exibir_traceback()
 
 # 4. Newsletters Ativas
 st.subheader("📬 Newsletters Ativas")
@@ -366,17 +712,14 @@ else:
 # 5.1 Calendário de Aniversários
 st.subheader("📅 Distribuição de Aniversários no Ano")
 try:
-    df_aniversarios = pd.DataFrame([p.get("aniversario", "") for p in dados_filtrados if p.get("aniversario", "não informado").lower() not in ["não informado", "nao informado"]], columns=["Data"])
-    # Remover entradas inválidas
-    df_aniversarios = df_aniversarios[df_aniversarios["Data"].str.contains("/")]
-    df_aniversarios[['Dia', 'Mês']] = df_aniversarios['Data'].str.split('/', expand=True).astype(float, errors='ignore')
-    df_aniversarios = df_aniversarios.dropna()
+    df_aniversarios = df_dados_filtrados.dropna(subset=['dia', 'mes']).astype({'dia': int, 'mes': int})
     
     if not df_aniversarios.empty:
         fig = px.density_heatmap(
             df_aniversarios,
-            x="Mês",
-            y="Dia",
+            x="mes",
+            y="dia",
+            labels={"mes": "Mês", "dia": "Dia"},
             nbinsx=12,
             nbinsy=31,
             color_continuous_scale="Viridis",
@@ -387,19 +730,14 @@ try:
         st.write("Dados insuficientes para gerar o calendário de aniversários.")
 except Exception as e:
     st.error(f"Erro ao gerar calendário: {str(e)}")
-    st.error(traceback.format_exc())
+    exibir_traceback()
 
 # 6. Busca de Perfis
 st.subheader("🔍 Busca de Membros")
 busca = st.text_input("Pesquisar por nome, área ou palavra-chave:")
 if busca:
     busca_lower = busca.lower()
-    resultados = [
-        p for p in dados_filtrados 
-        if busca_lower in p.get('nome', '').lower() 
-        or busca_lower in ' '.join(obter_areas(p)).lower() 
-        or busca_lower in ' '.join(obter_interesses(p)).lower()
-    ]
+    resultados = [p for p in dados_filtrados if busca_lower in p['_search_blob']]
 else:
     resultados = []
 
@@ -422,25 +760,11 @@ try:
     if not all(col in df_dados_filtrados.columns for col in required_columns):
         st.error("Dados insuficientes para gerar o gráfico de dispersão.")
     else:
-        # Agrupar dados por Localização com nomes de colunas únicos
-        agrupado = df_dados_filtrados.groupby('local').agg(
-            Numero_Areas=pd.NamedAgg(column='área', aggfunc=lambda x: sum(len(obter_areas({'área': a})) for a in x)),
-            Numero_Interesses=pd.NamedAgg(column='interesses', aggfunc=lambda x: sum(len(obter_interesses({'interesses': i})) for i in x)),
-            Interesses=pd.NamedAgg(column='interesses', aggfunc=lambda x: Counter([interest for p in x for interest in obter_interesses({'interesses': p})]))
-        ).reset_index()
-        
-        # Obter top 3 interesses por localização
-        agrupado['Top_Interesses'] = agrupado['Interesses'].apply(lambda c: ', '.join([interest for interest, count in c.most_common(3)]))
-        
-        # Renomear colunas para nomes únicos
-        df_atividades = agrupado.rename(columns={
-            'local': 'Local',
-            'Numero_Areas': 'Áreas',
-            'Numero_Interesses': 'Total_Interesses'  # Renomear para evitar duplicação
-        })
+        df_atividades = calcular_atividades(df_dados_filtrados, perfis_id, local_selecionado)
         
         # Depuração: Exibir os dados agrupados
-        st.write("### Dados Agrupados para o Gráfico de Dispersão", df_atividades.head())
+        if st.session_state.get('debug'):
+            st.write("### Dados Agrupados para o Gráfico de Dispersão", df_atividades.head())
         
         # Criar gráfico de dispersão com hover info detalhado
         fig = px.scatter(
@@ -470,23 +794,13 @@ try:
         st.plotly_chart(fig, use_container_width=True)
 except Exception as e:
     st.error(f"Erro ao gerar gráfico de dispersão: {str(e)}")
-    st.error(traceback.format_exc())
+    exibir_traceback()
 
 # 7. Insights de Networking
 st.subheader("🤝 Sugestões de Conexão")
 if len(dados_filtrados) >= 2:
     st.write("Membros com interesses complementares:")
-    pares = []
-    for i in range(len(dados_filtrados)):
-        interesses1 = set(obter_interesses(dados_filtrados[i]))
-        for j in range(i+1, len(dados_filtrados)):
-            interesses2 = set(obter_interesses(dados_filtrados[j]))
-            if interesses1 & interesses2:
-                pares.append((dados_filtrados[i].get('nome', 'Sem Nome'), dados_filtrados[j].get('nome', 'Sem Nome')))
-                if len(pares) >= 3:
-                    break
-        if len(pares) >= 3:
-            break
+    pares = calcular_pares(dados_filtrados, perfis_id, local_selecionado)
     if pares:
         for par in pares:
             st.write(f"- {par[0]} ↔ {par[1]}")